@@ -1,11 +1,32 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from pymongo import MongoClient
-from datetime import datetime, timezone, timedelta
-import time, uuid, os
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, ConfigDict
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, CollectionInvalid, ConnectionFailure, DuplicateKeyError, ExecutionTimeout, OperationFailure, PyMongoError
+from datetime import datetime, timezone
+from typing import Literal
+import asyncio, hashlib, logging, logging.handlers, queue, secrets, time, os
+import bson, orjson
+
+app = FastAPI(title="Smart Parking Backend", default_response_class=ORJSONResponse)
 
-app = FastAPI(title="Smart Parking Backend")
+# =====================================================
+# Logging
+# =====================================================
+# Request handlers only enqueue log records; a listener thread does the
+# blocking stream writes
+logger = logging.getLogger("parking")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler)
 
 # =====================================================
 # MongoDB
@@ -14,34 +35,72 @@ MONGO_URI = os.environ.get("MONGO_URI")
 if not MONGO_URI:
     raise RuntimeError("MONGO_URI not set")
 
-client = MongoClient(MONGO_URI)
+# history is write-only telemetry; set ENABLE_HISTORY=false (or 0/no) to skip it entirely
+ENABLE_HISTORY = os.environ.get("ENABLE_HISTORY", "true").strip().lower() not in ("false", "0", "no")
+
+# Pool sizes are per process: with uvicorn --workers N the server sees N times these
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", "200"))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", "20"))
+
+client = AsyncIOMotorClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,  # keep warm sockets; the TLS handshake to Atlas is slow
+    compressors="zstd,snappy,zlib", # zlib ships with Python, a fallback when the others are unavailable
+    zlibCompressionLevel=3,
+    retryWrites=True,
+    socketTimeoutMS=5000,
+    waitQueueTimeoutMS=2000,       # fail fast instead of queueing forever on an exhausted pool
+    serverSelectionTimeoutMS=2000,
+    connectTimeoutMS=2000,
+    appname=f"parking-backend-{os.getpid()}"  # tells workers apart in server logs
+)
 db = client["smart_parking"]
 
-parking_collection  = db["parking_spaces"]
-history_collection  = db["history"]
+# Primary ack only for live state; fire-and-forget for best-effort telemetry
+parking_collection  = db.get_collection("parking_spaces", write_concern=WriteConcern(w=1, j=False))
+history_collection  = db.get_collection("history", write_concern=WriteConcern(w=0))
 sessions_collection = db["parking_sessions"]
+daily_collection    = db["sessions_daily"]  # per node per UTC day rollup of parking_sessions
+meta_collection     = db["app_meta"]  # progress markers for background jobs
 
 # =====================================================
 # CORS
 # =====================================================
+# Comma-separated allowlist, e.g. CORS_ORIGINS="https://admin.example.com,https://kiosk.example.com"
+CORS_ORIGINS = [o.strip() for o in os.environ.get("CORS_ORIGINS", "*").split(",") if o.strip()]
+
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=CORS_ORIGINS,
     allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_methods=["GET", "POST"],
+    allow_headers=["Content-Type", "Authorization", "If-None-Match"],
+    expose_headers=["ETag", "X-Cache"],
 )
 
 # =====================================================
 # Models
 # =====================================================
+# Plain validation only: no whitespace stripping, assignment validation or alias lookup
+MODEL_CONFIG = ConfigDict(
+    extra="ignore",
+    populate_by_name=False,
+    str_strip_whitespace=False,
+    validate_assignment=False
+)
+
 class SensorUpdate(BaseModel):
+    model_config = MODEL_CONFIG
+
     node_id: str
-    sensor_status: str
+    sensor_status: Literal["FREE", "OCCUPIED"]
     distance_cm: float
     timestamp: int
 
 class ReservationRequest(BaseModel):
+    model_config = MODEL_CONFIG
+
     node_id: str
     reserved: bool
 
@@ -50,125 +109,565 @@ class ReservationRequest(BaseModel):
 # =====================================================
 RESERVATION_DURATION = 30  # seconds (testing)
 
+# Sensor states and admin modes, shared by the Python code and the pipelines
+STATUS_FREE = "FREE"
+STATUS_OCCUPIED = "OCCUPIED"
+MODE_NORMAL = "NORMAL"
+MODE_MAINTENANCE = "MAINTENANCE"
+DUPLICATE_KEY = 11000  # MongoDB error code
+
+# Node ids created on startup if missing, e.g. DEFAULT_NODES="A1,A2,A3"
+DEFAULT_NODES = [n.strip() for n in os.environ.get("DEFAULT_NODES", "").split(",") if n.strip()]
+BATCH_UPDATE_CONCURRENCY = 16  # nodes written at once per batch, well under the pool size
+HISTORY_FLUSH_INTERVAL = 0.2  # seconds
+HISTORY_BATCH_SIZE = 500
+HISTORY_QUEUE_SIZE = 10000  # records dropped beyond this rather than growing memory
+HISTORY_RETENTION = 30 * 86400  # seconds, for a newly created history collection
+STATUS_CACHE_TTL = 0.5  # seconds
+STATUS_QUERY_TIMEOUT_MS = 500
+EXPIRY_SWEEP_INTERVAL = 1  # seconds
+STATUS_WATCH_RETRY = 5  # seconds
+ROLLUP_RECONCILE_INTERVAL = 3600  # seconds
+ROLLUP_LEASE = 3600  # seconds one worker may hold the rollup reconcile
+ROLLUP_SETTLE = 300  # seconds a day must be closed before it is recomputed
+
+# Fields reset when a reservation is cancelled or expires
+RESERVATION_CLEARED = {
+    "reserved": False,
+    "reservation_start": None,
+    "reservation_expiry": None,
+    "qr_token": None,
+    "violation": False,
+    "checked_in": False
+}
+
 # =====================================================
 # Time Helpers
 # =====================================================
 def now_ts():
     return int(time.time())
 
-def ts_to_readable(ts: int | None):
-    if not ts:
-        return None
-    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime(
-        "%Y-%m-%d %H:%M:%S UTC"
-    )
+def readable_date(field: str):
+    # Aggregation expression formatting an epoch-seconds field, null if missing
+    return {"$dateToString": {
+        "format": "%Y-%m-%d %H:%M:%S UTC",
+        "date": {"$toDate": {"$multiply": ["$" + field, 1000]}}
+    }}
+
+def day_bucket(ts: int):
+    return ts - ts % 86400
 
 def start_of_today():
-    d = datetime.now(timezone.utc)
-    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp())
+    return day_bucket(now_ts())
 
 def start_of_week():
-    d = datetime.now(timezone.utc)
-    d = d - timedelta(days=d.weekday())
-    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp())
+    # Day 0 of the epoch was a Thursday, so Monday is 3 days earlier
+    day = now_ts() // 86400
+    return (day - (day + 3) % 7) * 86400
 
 # =====================================================
 # Default Node
 # =====================================================
-def create_default_node(node_id: str):
-    return {
-        "node_id": node_id,
-        "sensor_status": "FREE",
-        "distance_cm": 0.0,
-        "reserved": False,
-        "violation": False,
-        "reservation_start": None,
-        "reservation_expiry": None,
-        "admin_mode": "NORMAL",
-        "qr_token": None,
-        "checked_in": False,
-        "active_session_start": None,
-        "last_update": now_ts()
-    }
+# Every field except node_id and last_update
+DEFAULT_NODE = {
+    "sensor_status": STATUS_FREE,
+    "distance_cm": 0.0,
+    "reserved": False,
+    "violation": False,
+    "reservation_start": None,
+    "reservation_expiry": None,
+    "admin_mode": MODE_NORMAL,
+    "qr_token": None,
+    "checked_in": False,
+    "active_session_start": None
+}
+
+def create_default_node(node_id: str, now: int):
+    node = DEFAULT_NODE.copy()
+    node["node_id"] = node_id
+    node["last_update"] = now
+    return node
 
 # =====================================================
 # Core Logic
 # =====================================================
-def compute_final(node):
-    if node["admin_mode"] == "MAINTENANCE":
-        return "MAINTENANCE"
-    if node["reserved"] and not node["checked_in"] and node["sensor_status"] == "OCCUPIED":
-        return "VIOLATION"
-    if node["reserved"]:
-        return "RESERVED"
-    return node["sensor_status"]
-
-def enforce_expiry(node):
-    if node["reserved"] and node["reservation_expiry"]:
-        if now_ts() >= node["reservation_expiry"]:
-            parking_collection.update_one(
-                {"node_id": node["node_id"]},
-                {"$set": {
-                    "reserved": False,
-                    "reservation_start": None,
-                    "reservation_expiry": None,
-                    "qr_token": None,
-                    "violation": False,
-                    "checked_in": False,
-                    "last_update": now_ts()
-                }}
+# final_status: MAINTENANCE > VIOLATION > RESERVED > sensor_status
+FINAL_STATUS = {"$switch": {
+    "branches": [
+        {"case": {"$eq": ["$admin_mode", MODE_MAINTENANCE]}, "then": MODE_MAINTENANCE},
+        {"case": {"$and": [
+            "$reserved",
+            {"$not": ["$checked_in"]},
+            {"$eq": ["$sensor_status", STATUS_OCCUPIED]}
+        ]}, "then": "VIOLATION"},
+        {"case": "$reserved", "then": "RESERVED"}
+    ],
+    "default": "$sensor_status"
+}}
+
+# Reserved, not checked in, and a car is detected
+VIOLATION = {"$and": [
+    {"$eq": ["$admin_mode", MODE_NORMAL]},
+    "$reserved",
+    {"$not": ["$checked_in"]},
+    {"$eq": ["$sensor_status", STATUS_OCCUPIED]}
+]}
+
+# Builds the /api/parking/status entry for each node server-side
+STATUS_PROJECT_STAGE = {"$project": {
+    "_id": 0,
+    "node_id": 1,
+    "final_status": FINAL_STATUS,
+    "sensor_status": 1,
+    "distance_cm": 1,
+    "reserved": 1,
+    "violation": 1,
+    "admin_mode": 1,
+
+    # USER PAGE NEEDS THESE
+    "qr_token": {"$ifNull": ["$qr_token", None]},
+    "reservation_expiry": {"$ifNull": ["$reservation_expiry", None]},
+
+    # TIME
+    "server_timestamp": "$last_update",
+    "last_update_readable": readable_date("last_update")
+}}
+
+def expiry_stage(now: int):
+    # Clears a reservation whose expiry has passed
+    expired = {"$and": [
+        "$reserved",
+        "$reservation_expiry",
+        {"$gte": [now, "$reservation_expiry"]}
+    ]}
+    return {"$set": {
+        k: {"$cond": [expired, {"$literal": v}, "$" + k]}
+        for k, v in RESERVATION_CLEARED.items()
+    }}
+
+def status_pipeline(now: int):
+    # Expired reservations the sweep has not cleared yet are reported as cleared
+    return [expiry_stage(now), STATUS_PROJECT_STAGE]
+
+async def expire_reservations(now: int):
+    result = await parking_collection.update_many(
+        {"reserved": True, "reservation_expiry": {"$lte": now}},
+        {"$set": {**RESERVATION_CLEARED, "last_update": now}}
+    )
+    if result.modified_count:
+        invalidate_status_cache()
+
+async def expiry_sweep_loop():
+    while True:
+        try:
+            await expire_reservations(now_ts())
+        except PyMongoError:
+            logger.exception("Reservation expiry sweep failed")
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
+
+# Fills in DEFAULT_NODE when an upsert creates the node (node_id comes from
+# the query filter, last_update is always set by the caller)
+NODE_DEFAULTS_STAGE = {"$set": {
+    k: {"$ifNull": ["$" + k, {"$literal": v}]}
+    for k, v in DEFAULT_NODE.items()
+}}
+
+def sensor_update_pipeline(data: SensorUpdate, now: int):
+    status = {"$literal": data.sensor_status}
+
+    return [
+        # Defaults when the node is first seen (upsert)
+        NODE_DEFAULTS_STAGE,
+        # Reservation expiry
+        expiry_stage(now),
+        # Session start / end, sensor fields ("$sensor_status" is still the previous value here)
+        {"$set": {
+            "active_session_start": {"$switch": {
+                "branches": [
+                    {"case": {"$and": [{"$eq": ["$sensor_status", STATUS_FREE]}, {"$eq": [status, STATUS_OCCUPIED]}]},
+                     "then": now},
+                    {"case": {"$and": [{"$eq": ["$sensor_status", STATUS_OCCUPIED]}, {"$eq": [status, STATUS_FREE]}]},
+                     "then": None},
+                ],
+                "default": "$active_session_start"
+            }},
+            "sensor_status": status,
+            "distance_cm": data.distance_cm,
+            "last_update": now
+        }},
+        {"$set": {"violation": VIOLATION}}
+    ]
+
+# =====================================================
+# History Queue
+# =====================================================
+history_queue: asyncio.Queue[dict] = asyncio.Queue(maxsize=HISTORY_QUEUE_SIZE)
+history_dropped = {"count": 0}
+history_timeseries = {"enabled": False}  # set at startup from the collection options
+
+async def insert_history(batch):
+    try:
+        await history_collection.insert_many(batch, ordered=False)
+    except PyMongoError:
+        logger.exception("History flush failed, dropped %d records", len(batch))
+
+async def history_flush_loop():
+    # Flush once HISTORY_BATCH_SIZE records are queued or HISTORY_FLUSH_INTERVAL
+    # after the first record of a batch arrived, whichever comes first
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = []
+        try:
+            batch.append(await history_queue.get())
+            deadline = loop.time() + HISTORY_FLUSH_INTERVAL
+            while len(batch) < HISTORY_BATCH_SIZE:
+                if not history_queue.empty():
+                    batch.append(history_queue.get_nowait())
+                    continue
+                try:
+                    batch.append(await asyncio.wait_for(history_queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+        except asyncio.CancelledError:
+            # Shutdown: write the records already taken off the queue
+            if batch:
+                await insert_history(batch)
+            raise
+        await insert_history(batch)
+
+async def flush_history():
+    while not history_queue.empty():
+        batch = []
+        while len(batch) < HISTORY_BATCH_SIZE and not history_queue.empty():
+            batch.append(history_queue.get_nowait())
+        await insert_history(batch)
+
+# =====================================================
+# Status Cache
+# =====================================================
+# body is the orjson-encoded response, so cache hits skip serialization; it is
+# kept after invalidation so it can be served stale if Mongo is unreachable
+# While the parking_spaces change stream is up ("watched"), every write from
+# any worker invalidates the cache, so it is held until the next change
+# instead of expiring after STATUS_CACHE_TTL
+status_cache = {
+    "ts": float("-inf"),
+    "body": None,
+    "etag": None,
+    "stale": False,
+    "watched": False,
+    "version": 0
+}
+status_lock = asyncio.Lock()
+
+def status_cache_fresh():
+    if status_cache["watched"] and not status_cache["stale"]:
+        return status_cache["ts"] != float("-inf")
+    return time.monotonic() - status_cache["ts"] < STATUS_CACHE_TTL
+
+def invalidate_status_cache():
+    # Called after every parking_spaces write so the next poll sees it
+    status_cache["version"] += 1
+    status_cache["ts"] = float("-inf")
+
+async def watch_parking_changes():
+    while True:
+        try:
+            # Only the resume token is needed from each event
+            async with parking_collection.watch([{"$project": {"_id": 1}}]) as stream:
+                # watch() is lazy: open the stream on the server before relying on it.
+                # Any event returned here is covered by the invalidation below.
+                await stream.try_next()
+                status_cache["watched"] = True
+                invalidate_status_cache()
+                async for _ in stream:
+                    invalidate_status_cache()
+        except OperationFailure:
+            # Change streams need a replica set; stay on the TTL cache
+            logger.warning("parking_spaces change stream unavailable, using TTL status cache", exc_info=True)
+            return
+        except PyMongoError:
+            logger.warning("parking_spaces change stream lost, retrying", exc_info=True)
+        finally:
+            status_cache["watched"] = False
+            invalidate_status_cache()
+        await asyncio.sleep(STATUS_WATCH_RETRY)
+
+# =====================================================
+# Startup / Shutdown
+# =====================================================
+background_tasks: list[asyncio.Task] = []
+
+async def create_history_collection():
+    # New deployments store history as a time-series collection bucketed per node.
+    # An existing regular collection is left as it is and keeps epoch-int
+    # timestamps. To migrate, create a time-series collection as below under
+    # another name, copy the documents with timestamp converted via $toDate
+    # (epoch seconds * 1000), then rename it over history.
+    existing = await (await db.list_collections(filter={"name": "history"})).to_list(None)
+    if not existing:
+        try:
+            await db.create_collection(
+                "history",
+                timeseries={"timeField": "timestamp", "metaField": "node_id", "granularity": "seconds"},
+                expireAfterSeconds=HISTORY_RETENTION
             )
+        except CollectionInvalid:
+            pass  # created by another worker
+        existing = await (await db.list_collections(filter={"name": "history"})).to_list(None)
+
+    history_timeseries["enabled"] = bool(existing and existing[0].get("options", {}).get("timeseries"))
+
+async def ensure_indexes():
+    indexes = [
+        parking_collection.create_index("node_id", unique=True),
+        parking_collection.create_index(
+            "reservation_expiry", partialFilterExpression={"reserved": True}
+        ),
+        sessions_collection.create_index([("end_time", -1)]),
+        sessions_collection.create_index([("node_id", 1), ("end_time", -1)]),
+        daily_collection.create_index([("day", 1), ("node_id", 1)], unique=True)
+    ]
+    if ENABLE_HISTORY:
+        indexes.append(history_collection.create_index([("node_id", 1), ("timestamp", -1)]))
+    await asyncio.gather(*indexes)
+
+async def reconcile_daily_rollups():
+    # Recomputes sessions_daily for closed days from parking_sessions, which
+    # also picks up sessions written without a rollup (older instances during
+    # a rolling deploy). app_meta records the first day not yet recomputed.
+    # Live $inc writes only touch the current day, so replacing closed days
+    # cannot overwrite them, and rerunning a day gives the same result.
+    now = now_ts()
+    cutoff = day_bucket(now - ROLLUP_SETTLE)
+
+    # One worker at a time; the lease lets another take over after a crash.
+    # A marker that is up to date or leased fails the filter, and the upsert
+    # then collides on _id.
+    try:
+        prev = await meta_collection.find_one_and_update(
+            {
+                "_id": "sessions_daily",
+                "through": {"$not": {"$gte": cutoff}},
+                "lease_until": {"$not": {"$gt": now}}
+            },
+            {"$set": {"lease_until": now + ROLLUP_LEASE}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        return
+    start = (prev or {}).get("through", 0)
+
+    # A full rebuild can outlast the request socket timeout
+    rollup_client = AsyncIOMotorClient(MONGO_URI, socketTimeoutMS=None, appname="parking-backend-rollup")
+    try:
+        await rollup_client["smart_parking"]["parking_sessions"].aggregate([
+            {"$match": {"end_time": {"$gte": start, "$lt": cutoff}}},
+            {"$group": {
+                "_id": {
+                    "node_id": "$node_id",
+                    "day": {"$subtract": ["$end_time", {"$mod": ["$end_time", 86400]}]}
+                },
+                "total_sessions": {"$sum": 1},
+                "total_time": {"$sum": "$duration_seconds"}
+            }},
+            {"$project": {
+                "_id": 0,
+                "node_id": "$_id.node_id",
+                "day": "$_id.day",
+                "total_sessions": 1,
+                "total_time": 1
+            }},
+            {"$merge": {
+                "into": "sessions_daily",
+                "on": ["day", "node_id"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert"
+            }}
+        ]).to_list(None)
+    except BaseException:
+        await meta_collection.update_one({"_id": "sessions_daily"}, {"$set": {"lease_until": 0}})
+        raise
+    finally:
+        rollup_client.close()
+
+    # Only advanced once the $merge has completed
+    await meta_collection.update_one(
+        {"_id": "sessions_daily"}, {"$set": {"through": cutoff, "lease_until": 0}}
+    )
+    logger.info("sessions_daily recomputed for days before %d", cutoff)
+
+async def rollup_reconcile_loop():
+    while True:
+        try:
+            await reconcile_daily_rollups()
+        except PyMongoError:
+            logger.exception("sessions_daily reconcile failed")
+        await asyncio.sleep(ROLLUP_RECONCILE_INTERVAL)
+
+async def seed_default_nodes():
+    if not DEFAULT_NODES:
+        return
+
+    now = now_ts()
+    try:
+        await parking_collection.insert_many(
+            [create_default_node(node_id, now) for node_id in DEFAULT_NODES],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        # Nodes that already exist are rejected by the unique node_id index
+        if any(err["code"] != DUPLICATE_KEY for err in e.details["writeErrors"]):
+            raise
+
+@app.on_event("startup")
+async def startup():
+    log_listener.start()
+    # Connect before serving so the first request does not pay for the handshake
+    await client.admin.command("ping")
+    if not bson.has_c():
+        logger.warning("bson C extension not available, BSON encoding falls back to pure Python")
+    if ENABLE_HISTORY:
+        await create_history_collection()
+    await ensure_indexes()
+    await seed_default_nodes()
+
+    background_tasks.append(asyncio.create_task(rollup_reconcile_loop()))
+    background_tasks.append(asyncio.create_task(expiry_sweep_loop()))
+    background_tasks.append(asyncio.create_task(watch_parking_changes()))
+    if ENABLE_HISTORY:
+        background_tasks.append(asyncio.create_task(history_flush_loop()))
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await flush_history()
+    log_listener.stop()
 
 # =====================================================
 # Sensor Update (Gateway)
 # =====================================================
-@app.post("/api/node/update")
-def update_node(data: SensorUpdate):
-    node = parking_collection.find_one({"node_id": data.node_id})
-    if not node:
-        node = create_default_node(data.node_id)
-        parking_collection.insert_one(node)
-
-    enforce_expiry(node)
+def session_doc(node_id: str, start: int, now: int):
+    return {
+        "node_id": node_id,
+        "start_time": start,
+        "end_time": now,
+        "duration_seconds": now - start
+    }
 
-    prev = node["sensor_status"]
+async def record_sessions(sessions):
+    # Session inserts and their daily rollup increments are independent
+    await asyncio.gather(
+        sessions_collection.insert_many(sessions, ordered=False),
+        daily_collection.bulk_write(
+            [
+                UpdateOne(
+                    {"day": day_bucket(s["end_time"]), "node_id": s["node_id"]},
+                    {"$inc": {"total_sessions": 1, "total_time": s["duration_seconds"]}},
+                    upsert=True
+                )
+                for s in sessions
+            ],
+            ordered=False
+        )
+    )
 
-    # Session start
-    if prev == "FREE" and data.sensor_status == "OCCUPIED":
-        node["active_session_start"] = now_ts()
+def queue_history(updates, now: int):
+    if not ENABLE_HISTORY:
+        return
 
-    # Session end
-    if prev == "OCCUPIED" and data.sensor_status == "FREE":
-        if node.get("active_session_start"):
-            sessions_collection.insert_one({
+    # Time-series collections require a BSON date for the time field; a regular
+    # collection keeps the epoch ints it already holds
+    timestamp = datetime.fromtimestamp(now, timezone.utc) if history_timeseries["enabled"] else now
+    for data in updates:
+        try:
+            history_queue.put_nowait({
                 "node_id": data.node_id,
-                "start_time": node["active_session_start"],
-                "end_time": now_ts(),
-                "duration_seconds": now_ts() - node["active_session_start"]
+                "sensor_status": data.sensor_status,
+                "distance_cm": data.distance_cm,
+                "timestamp": timestamp
             })
-        node["active_session_start"] = None
-
-    node.update({
-        "sensor_status": data.sensor_status,
-        "distance_cm": data.distance_cm,
-        "last_update": now_ts()
-    })
-
-    node["violation"] = (
-        node["admin_mode"] == "NORMAL"
-        and node["reserved"]
-        and not node["checked_in"]
-        and data.sensor_status == "OCCUPIED"
+        except asyncio.QueueFull:
+            history_dropped["count"] += 1
+            if history_dropped["count"] % HISTORY_BATCH_SIZE == 1:
+                logger.warning("History queue full, %d records dropped", history_dropped["count"])
+
+async def apply_sensor_update(data: SensorUpdate, now: int):
+    # One round-trip: upsert, expiry, session stamping and violation run server-side.
+    # The previous document comes from the write itself, so a session end is
+    # seen by exactly one request even when updates for a node race.
+    prev = await parking_collection.find_one_and_update(
+        {"node_id": data.node_id},
+        sensor_update_pipeline(data, now),
+        projection={"_id": 0, "sensor_status": 1, "active_session_start": 1},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+
+    # Session end
+    if prev and prev["sensor_status"] == STATUS_OCCUPIED and data.sensor_status == STATUS_FREE:
+        if prev.get("active_session_start"):
+            return session_doc(data.node_id, prev["active_session_start"], now)
+    return None
+
+@app.post("/api/node/update")
+async def update_node(data: SensorUpdate):
+    now = now_ts()
+
+    session = await apply_sensor_update(data, now)
+    invalidate_status_cache()
+
+    if session:
+        await record_sessions([session])
+
+    queue_history([data], now)
+
+    return {"status": "ok"}
+
+@app.post("/api/node/batch_update")
+async def batch_update_nodes(updates: list[SensorUpdate]):
+    if not updates:
+        return {"status": "ok"}
+
+    now = now_ts()
+
+    readings_by_node: dict[str, list[SensorUpdate]] = {}
+    for data in updates:
+        readings_by_node.setdefault(data.node_id, []).append(data)
+
+    # Filled as writes land, so a failure on one node does not lose the
+    # sessions already ended on the others
+    sessions, applied = [], []
+    limit = asyncio.Semaphore(BATCH_UPDATE_CONCURRENCY)
+
+    async def apply_readings(readings):
+        # A node's readings apply in the order they were sent
+        async with limit:
+            for data in readings:
+                session = await apply_sensor_update(data, now)
+                applied.append(data)
+                if session:
+                    sessions.append(session)
+
+    # Nodes run concurrently, so the batch costs a few round-trips per reading
+    # of its busiest node rather than one per reading
+    results = await asyncio.gather(
+        *(apply_readings(r) for r in readings_by_node.values()), return_exceptions=True
     )
+    invalidate_status_cache()
 
-    parking_collection.update_one({"node_id": data.node_id}, {"$set": node})
+    if sessions:
+        await record_sessions(sessions)
 
-    history_collection.insert_one({
-        "node_id": data.node_id,
-        "sensor_status": data.sensor_status,
-        "distance_cm": data.distance_cm,
-        "timestamp": now_ts()
-    })
+    queue_history(applied, now)
+
+    errors = [e for e in results if isinstance(e, BaseException)]
+    if errors:
+        logger.error("Batch update failed for %d of %d nodes", len(errors), len(results), exc_info=errors[0])
+        raise HTTPException(503, f"Update failed for {len(errors)} of {len(results)} nodes")
 
     return {"status": "ok"}
 
@@ -176,189 +675,266 @@ def update_node(data: SensorUpdate):
 # Reservation (QR generation)
 # =====================================================
 @app.post("/api/reserve")
-def reserve_space(req: ReservationRequest):
-    node = parking_collection.find_one({"node_id": req.node_id})
-    if not node:
-        node = create_default_node(req.node_id)
-        parking_collection.insert_one(node)
-
-    if node["admin_mode"] == "MAINTENANCE":
-        raise HTTPException(400, "Node in maintenance")
+async def reserve_space(req: ReservationRequest):
+    now = now_ts()
 
     if req.reserved:
-        parking_collection.update_one(
-            {"node_id": req.node_id},
+        changes = [
             {"$set": {
                 "reserved": True,
-                "reservation_start": now_ts(),
-                "reservation_expiry": now_ts() + RESERVATION_DURATION,
-                "qr_token": str(uuid.uuid4()),
+                "reservation_start": now,
+                "reservation_expiry": now + RESERVATION_DURATION,
+                "qr_token": secrets.token_urlsafe(16),
                 "checked_in": False,
-                "last_update": now_ts()
-            }}
-        )
+                "last_update": now
+            }},
+            {"$set": {"violation": VIOLATION}}
+        ]
     else:
-        parking_collection.update_one(
-            {"node_id": req.node_id},
-            {"$set": {
-                "reserved": False,
-                "reservation_start": None,
-                "reservation_expiry": None,
-                "qr_token": None,
-                "violation": False,
-                "checked_in": False,
-                "last_update": now_ts()
-            }}
-        )
+        changes = [{"$set": {**RESERVATION_CLEARED, "last_update": now}}]
+
+    # A missing node is created with defaults. The upsert hits the unique
+    # node_id index either when the node is in maintenance (filter fails) or
+    # when a concurrent request created it first; retrying without upsert
+    # tells the two apart.
+    node_filter = {"node_id": req.node_id, "admin_mode": {"$ne": MODE_MAINTENANCE}}
+    pipeline = [NODE_DEFAULTS_STAGE, *changes]
+    try:
+        await parking_collection.update_one(node_filter, pipeline, upsert=True)
+    except DuplicateKeyError:
+        result = await parking_collection.update_one(node_filter, pipeline)
+        if not result.matched_count:
+            raise HTTPException(400, "Node in maintenance")
+
+    invalidate_status_cache()
 
     return {"status": "ok"}
 
 # =====================================================
 # STATUS (User + Admin)
 # =====================================================
-@app.get("/api/parking/status")
-def get_status():
+async def load_status():
     out = {}
-    for node in parking_collection.find():
-        enforce_expiry(node)
-
-        out[node["node_id"]] = {
-            "final_status": compute_final(node),
-            "sensor_status": node["sensor_status"],
-            "distance_cm": node["distance_cm"],
-            "reserved": node["reserved"],
-            "violation": node["violation"],
-            "admin_mode": node["admin_mode"],
-
-            # USER PAGE NEEDS THESE
-            "qr_token": node.get("qr_token"),
-            "reservation_expiry": node.get("reservation_expiry"),
-
-            # TIME
-            "server_timestamp": node["last_update"],
-            "last_update_readable": ts_to_readable(node["last_update"])
-        }
+    async for node in parking_collection.aggregate(
+        status_pipeline(now_ts()), maxTimeMS=STATUS_QUERY_TIMEOUT_MS
+    ):
+        out[node.pop("node_id")] = node
     return out
 
+async def refresh_status():
+    # Caller holds status_lock
+    if status_cache_fresh():
+        return
+
+    version = status_cache["version"]
+    try:
+        # Bounded so an unreachable server costs at most the status budget,
+        # not the full server selection timeout
+        data = await asyncio.wait_for(load_status(), STATUS_QUERY_TIMEOUT_MS / 1000)
+    except (ConnectionFailure, ExecutionTimeout, asyncio.TimeoutError):
+        if status_cache["body"] is None:
+            raise HTTPException(503, "Database unavailable")
+        # Serve the last good response and retry after another TTL
+        logger.warning("Status query failed, serving stale response", exc_info=True)
+        status_cache.update({"ts": time.monotonic(), "stale": True})
+    else:
+        body = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+        # A write that landed while the query ran may not be in data:
+        # serve it to this request but refresh again on the next one
+        status_cache.update({
+            "ts": time.monotonic() if status_cache["version"] == version else float("-inf"),
+            "body": body,
+            "etag": '"%s"' % hashlib.md5(body).hexdigest(),
+            "stale": False
+        })
+
+@app.get("/api/parking/status")
+async def get_status(request: Request):
+    stale = False
+    if not status_cache_fresh():
+        if status_cache["body"] is None:
+            # Nothing to fall back to; the refresh itself is bounded
+            async with status_lock:
+                await refresh_status()
+        elif status_cache["stale"] and status_lock.locked():
+            # Known outage: serve the stale body instead of queueing behind a retry
+            pass
+        else:
+            # Concurrent polls wait for a single refresh, so a poll right after a
+            # write sees it, but never longer than the status budget
+            try:
+                await asyncio.wait_for(status_lock.acquire(), STATUS_QUERY_TIMEOUT_MS / 1000)
+            except asyncio.TimeoutError:
+                stale = True
+            else:
+                try:
+                    await refresh_status()
+                finally:
+                    status_lock.release()
+    stale = stale or status_cache["stale"]
+
+    headers = {"ETag": status_cache["etag"], "Cache-Control": "max-age=1"}
+    if stale:
+        headers["X-Cache"] = "stale"
+
+    # Unchanged since the client's last poll: skip the body entirely
+    if_none_match = request.headers.get("if-none-match", "")
+    if status_cache["etag"] in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=headers)
+
+    return Response(status_cache["body"], media_type="application/json", headers=headers)
+
 
 # =====================================================
 # GATEWAY BOOTSTRAP (ADDED - DOES NOT MODIFY EXISTING LOGIC)
 # =====================================================
 @app.get("/api/nodes")
-def get_nodes():
+async def get_nodes():
     return [
         node["node_id"]
-        for node in parking_collection.find({}, {"_id": 0, "node_id": 1})
+        async for node in parking_collection.find({}, {"_id": 0, "node_id": 1})
     ]
 
 # =====================================================
 # ADMIN CONTROLS
 # =====================================================
 @app.post("/api/admin/maintenance/{node_id}")
-def admin_maintenance(node_id: str):
-    parking_collection.update_one(
+async def admin_maintenance(node_id: str):
+    await parking_collection.update_one(
         {"node_id": node_id},
         {"$set": {
-            "admin_mode": "MAINTENANCE",
+            "admin_mode": MODE_MAINTENANCE,
             "reserved": False,
             "qr_token": None,
             "violation": False,
             "last_update": now_ts()
         }}
     )
+    invalidate_status_cache()
     return {"status": "ok"}
 
 @app.post("/api/admin/resume/{node_id}")
-def admin_resume(node_id: str):
-    parking_collection.update_one(
+async def admin_resume(node_id: str):
+    await parking_collection.update_one(
         {"node_id": node_id},
         {"$set": {
-            "admin_mode": "NORMAL",
+            "admin_mode": MODE_NORMAL,
             "last_update": now_ts()
         }}
     )
+    invalidate_status_cache()
     return {"status": "ok"}
 
 # =====================================================
 # ADMIN ANALYTICS
 # =====================================================
-@app.get("/api/admin/analytics/usage-by-node")
-def usage_by_node(range: str | None = None):
-    match = {}
-    if range == "today":
-        match["end_time"] = {"$gte": start_of_today()}
-    elif range == "week":
-        match["end_time"] = {"$gte": start_of_week()}
-
-    pipeline = []
-    if match:
-        pipeline.append({"$match": match})
-
-    pipeline.extend([
-        {"$group": {
-            "_id": "$node_id",
-            "total_sessions": {"$sum": 1},
-            "total_time": {"$sum": "$duration_seconds"},
-            "avg_time": {"$avg": "$duration_seconds"}
-        }},
-        {"$project": {
-            "_id": 0,
-            "node_id": "$_id",
-            "total_sessions": 1,
-            "total_time_seconds": "$total_time",
-            "average_time_seconds": {"$round": ["$avg_time", 1]}
-        }}
-    ])
-
-    return list(sessions_collection.aggregate(pipeline))
-
-@app.get("/api/admin/analytics/summary")
-def usage_summary(range: str | None = None):
-    match = {}
+# Usage analytics read the sessions_daily rollup; ranges are day aligned so
+# filtering on day is equivalent to filtering sessions on end_time
+def range_start(range: str | None):
     if range == "today":
-        match["end_time"] = {"$gte": start_of_today()}
-    elif range == "week":
-        match["end_time"] = {"$gte": start_of_week()}
-
-    pipeline = []
-    if match:
-        pipeline.append({"$match": match})
+        return start_of_today()
+    if range == "week":
+        return start_of_week()
+    return None
+
+def aggregate_daily(range: str | None, stages):
+    # Never spill to disk; pin the day index for ranged queries
+    start = range_start(range)
+    if start is None:
+        return daily_collection.aggregate(stages, allowDiskUse=False)
+    return daily_collection.aggregate(
+        [{"$match": {"day": {"$gte": start}}}, *stages],
+        allowDiskUse=False,
+        hint=[("day", 1), ("node_id", 1)]
+    )
 
-    pipeline.append({"$group": {
+USAGE_BY_NODE_STAGES = [
+    {"$group": {
+        "_id": "$node_id",
+        "total_sessions": {"$sum": "$total_sessions"},
+        "total_time": {"$sum": "$total_time"}
+    }},
+    {"$project": {
+        "_id": 0,
+        "node_id": "$_id",
+        "total_sessions": 1,
+        "total_time_seconds": "$total_time",
+        "average_time_seconds": {"$round": [{"$divide": ["$total_time", "$total_sessions"]}, 1]}
+    }}
+]
+
+SUMMARY_STAGES = [
+    {"$group": {
         "_id": None,
-        "total_sessions": {"$sum": 1},
-        "total_time": {"$sum": "$duration_seconds"},
-        "avg_time": {"$avg": "$duration_seconds"}
-    }})
+        "total_sessions": {"$sum": "$total_sessions"},
+        "total_time": {"$sum": "$total_time"}
+    }}
+]
 
-    r = list(sessions_collection.aggregate(pipeline))
-    if not r:
+def format_summary(rows):
+    if not rows:
         return {"total_sessions": 0, "total_time_seconds": 0, "average_time_seconds": 0}
 
-    r = r[0]
+    r = rows[0]
     return {
         "total_sessions": r["total_sessions"],
         "total_time_seconds": r["total_time"],
-        "average_time_seconds": round(r["avg_time"], 1)
+        "average_time_seconds": round(r["total_time"] / r["total_sessions"], 1)
     }
 
+@app.get("/api/admin/analytics/usage-by-node")
+async def usage_by_node(range: str | None = None):
+    return await aggregate_daily(range, USAGE_BY_NODE_STAGES).to_list(None)
+
+@app.get("/api/admin/analytics/summary")
+async def usage_summary(range: str | None = None):
+    r = await aggregate_daily(range, SUMMARY_STAGES).to_list(None)
+    return format_summary(r)
+
+@app.get("/api/admin/analytics/combined")
+@app.get("/api/admin/analytics/overview")
+async def usage_combined(range: str | None = None):
+    # usage-by-node + summary in one round-trip sharing a single $match scan
+    pipeline = [{"$facet": {
+        "by_node": USAGE_BY_NODE_STAGES,
+        "summary": SUMMARY_STAGES
+    }}]
+
+    r = (await aggregate_daily(range, pipeline).to_list(None))[0]
+    return {
+        "by_node": r["by_node"],
+        "summary": format_summary(r["summary"])
+    }
+
+async def stream_json_array(first, docs):
+    yield b"[" + orjson.dumps(first)
+    async for doc in docs:
+        yield b"," + orjson.dumps(doc)
+    yield b"]"
+
 @app.get("/api/admin/analytics/recent-sessions")
-def recent_sessions(limit: int = 10, range: str | None = None):
-    query = {}
-    if range == "today":
-        query["end_time"] = {"$gte": start_of_today()}
-    elif range == "week":
-        query["end_time"] = {"$gte": start_of_week()}
-
-    out = []
-    for s in (
-        sessions_collection
-        .find(query, {"_id": 0})
-        .sort("end_time", -1)
-        .limit(limit)
-    ):
-        s["start_time_readable"] = ts_to_readable(s["start_time"])
-        s["end_time_readable"] = ts_to_readable(s["end_time"])
-        out.append(s)
+async def recent_sessions(limit: int = Query(10, ge=0), range: str | None = None):
+    start = range_start(range)
+    query = {"end_time": {"$gte": start}} if start is not None else {}
+
+    # limit=0 means no limit, as with find().limit(0); $limit only accepts positive values
+    sessions = sessions_collection.aggregate([
+        {"$match": query},
+        {"$sort": {"end_time": -1}},
+        *([{"$limit": limit}] if limit else []),
+        {"$project": {"_id": 0}},
+        {"$set": {
+            "start_time_readable": readable_date("start_time"),
+            "end_time_readable": readable_date("end_time")
+        }}
+    ])
+
+    # Read the first document before streaming so query errors still become an
+    # error status rather than a truncated 200
+    try:
+        first = await sessions.next()
+    except StopAsyncIteration:
+        return []
 
-    return out
\ No newline at end of file
+    # Streamed so large limits are sent as the cursor is read, in constant memory
+    return StreamingResponse(stream_json_array(first, sessions), media_type="application/json")